@@ -1,22 +1,34 @@
 ﻿import argparse
 import base64
+import functools
+import http.client
 import json
 import os
+import ssl
 import sys
+import time
 from collections import defaultdict
 from datetime import datetime
-from typing import Dict, List, Optional, Tuple
+from operator import itemgetter
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 from urllib import error, parse, request
 from zoneinfo import ZoneInfo
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
 API_BASE_URL = "https://api.planningcenteronline.com/services/v2/service_types/1069223/plans"
 APP_ID_ENV = "PLANNING_CENTER_APP_ID"
 SECRET_ENV = "PLANNING_CENTER_SECRET"
-PLAN_ID: Optional[str] = None
-PLAN_TIMES: Dict[str, str] = {}
-PLAN_ITEMS_BY_TIME: Dict[str, List[Dict[str, object]]] = {}
 UTC_ZONE = ZoneInfo("UTC")
 CENTRAL_ZONE = ZoneInfo("America/Chicago")
+REQUEST_TIMEOUT_SECONDS = 30
+MAX_RETRIES = 3
+RETRY_BACKOFF_SECONDS = 0.3
+MAX_RETRY_AFTER_SECONDS = 60
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
 
 
 def valid_date(value: str) -> str:
@@ -81,70 +93,112 @@ def build_plan_items_url(plan_id: str) -> str:
     return f"{API_BASE_URL}/{plan_id}/items?include=item_times"
 
 
-def build_request(url: str, app_id: str, secret: str) -> request.Request:
+def build_headers(app_id: str, secret: str) -> Dict[str, str]:
     credentials = f"{app_id}:{secret}".encode("utf-8")
     encoded_credentials = base64.b64encode(credentials).decode("ascii")
-    headers = {
+    return {
         "Authorization": f"Basic {encoded_credentials}",
         "Accept": "application/json",
         "User-Agent": "planning-center-integration/0.1",
     }
-    return request.Request(url, headers=headers)
 
 
-def fetch_json(url: str, context: str) -> dict:
-    app_id, secret = get_credentials()
-    req = build_request(url, app_id, secret)
+def retry_delay(attempt: int, retry_after: Optional[str] = None) -> float:
+    """Seconds to wait before retry number ``attempt`` (zero-based)."""
+    if retry_after and retry_after.isdigit():
+        return min(float(retry_after), MAX_RETRY_AFTER_SECONDS)
+    return RETRY_BACKOFF_SECONDS * (2 ** attempt)
 
-    try:
-        with request.urlopen(req) as response:
-            payload = response.read().decode("utf-8")
-    except error.HTTPError as exc:
-        body = exc.read().decode("utf-8", errors="replace")
-        raise RuntimeError(
-            f"{context} request failed with status {exc.code}: {body}"
-        ) from exc
-    except error.URLError as exc:
-        raise RuntimeError(f"Failed to reach API for {context}: {exc.reason}") from exc
+
+def fetch_json(
+    url: str, context: str, opener: request.OpenerDirector, headers: Dict[str, str]
+) -> dict:
+    req = request.Request(url, headers=headers)
+
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            with opener.open(req, timeout=REQUEST_TIMEOUT_SECONDS) as response:
+                body = response.read()
+            break
+        except error.HTTPError as exc:
+            # Planning Center rate-limits with 429 and a Retry-After header.
+            if exc.code in RETRY_STATUSES and attempt < MAX_RETRIES:
+                retry_after = exc.headers.get("Retry-After")
+                exc.close()
+                time.sleep(retry_delay(attempt, retry_after))
+                continue
+            message = exc.read().decode("utf-8", errors="replace")
+            raise RuntimeError(
+                f"{context} request failed with status {exc.code}: {message}"
+            ) from exc
+        except (OSError, http.client.HTTPException) as exc:
+            reason = exc.reason if isinstance(exc, error.URLError) else exc
+            # A failed certificate check will not fix itself; dropped TLS
+            # connections (SSLEOFError and friends) are retried like any other.
+            permanent = isinstance(reason, ssl.SSLCertVerificationError)
+            if permanent or attempt == MAX_RETRIES:
+                raise RuntimeError(
+                    f"Failed to reach API for {context}: {reason}"
+                ) from exc
+            time.sleep(retry_delay(attempt))
 
     try:
-        return json.loads(payload)
-    except json.JSONDecodeError as exc:
+        return json_loads(body)
+    except (UnicodeDecodeError, json.JSONDecodeError) as exc:
         raise RuntimeError(f"{context} response was not valid JSON") from exc
 
 
-def fetch_plan(after_date: str) -> dict:
+def fetch_plan(
+    after_date: str, opener: request.OpenerDirector, headers: Dict[str, str]
+) -> dict:
     url = build_url(after_date)
-    data = fetch_json(url, "Plan")
+    return fetch_json(url, "Plan", opener, headers)
+
 
-    global PLAN_ID
+def extract_plan_id(plan: dict) -> Optional[str]:
     try:
-        PLAN_ID = str(data["data"][0]["id"])
+        return str(plan["data"][0]["id"])
     except (KeyError, IndexError, TypeError):
-        PLAN_ID = None
-
-    return data
+        return None
 
 
-def fetch_plan_times(plan_id: str) -> dict:
+def fetch_plan_times(
+    plan_id: str, opener: request.OpenerDirector, headers: Dict[str, str]
+) -> dict:
     url = build_plan_times_url(plan_id)
-    return fetch_json(url, "Plan times")
+    return fetch_json(url, "Plan times", opener, headers)
 
 
-def fetch_plan_items(plan_id: str) -> dict:
-    url = build_plan_items_url(plan_id)
-    return fetch_json(url, "Plan items")
+def index_included(response: dict) -> Dict[Tuple[str, str], dict]:
+    """Key the sideloaded JSON:API resources by (type, id)."""
+    included = response.get("included")
+    if not isinstance(included, list):
+        return {}
 
+    index: Dict[Tuple[str, str], dict] = {}
+    for resource in included:
+        if not isinstance(resource, dict):
+            continue
+        resource_type = resource.get("type")
+        resource_id = resource.get("id")
+        if isinstance(resource_type, str) and isinstance(resource_id, str):
+            index[(resource_type, resource_id)] = resource
+    return index
 
-def fetch_item_time_detail(base_url: str, item_time_id: str) -> dict:
-    url = f"{base_url.rstrip('/')}/{item_time_id}"
-    return fetch_json(url, "Item time")
+
+def fetch_plan_items(
+    plan_id: str, opener: request.OpenerDirector, headers: Dict[str, str]
+) -> Tuple[dict, Dict[Tuple[str, str], dict]]:
+    url = build_plan_items_url(plan_id)
+    data = fetch_json(url, "Plan items", opener, headers)
+    return data, index_included(data)
 
 
-def to_central_iso(timestamp: str) -> Optional[str]:
+@functools.lru_cache(maxsize=256)
+def to_central_time(timestamp: str) -> Optional[datetime]:
     """Convert an ISO8601 timestamp to America/Chicago time."""
     try:
-        parsed = datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+        parsed = datetime.fromisoformat(timestamp)
     except ValueError:
         return None
 
@@ -152,19 +206,17 @@ def to_central_iso(timestamp: str) -> Optional[str]:
         parsed = parsed.replace(tzinfo=UTC_ZONE)
 
     try:
-        converted = parsed.astimezone(CENTRAL_ZONE)
+        return parsed.astimezone(CENTRAL_ZONE)
     except ValueError:
         return None
-    return converted.isoformat()
 
 
-def stash_service_times(plan_times: dict) -> None:
-    global PLAN_TIMES
-    PLAN_TIMES = {}
+def collect_service_times(plan_times: dict) -> Dict[str, Union[datetime, str]]:
+    service_times: Dict[str, Union[datetime, str]] = {}
 
     entries = plan_times.get("data")
     if not isinstance(entries, list):
-        return
+        return service_times
 
     for entry in entries:
         attributes = entry.get("attributes") if isinstance(entry, dict) else None
@@ -178,116 +230,104 @@ def stash_service_times(plan_times: dict) -> None:
         if not (isinstance(plan_time_id, str) and isinstance(starts_at, str)):
             continue
 
-        converted = to_central_iso(starts_at)
-        PLAN_TIMES[plan_time_id] = converted or starts_at
+        # Unparseable timestamps keep the raw string so their items still show up.
+        converted = to_central_time(starts_at)
+        service_times[plan_time_id] = converted or starts_at
+
+    return service_times
 
 
-def map_items_by_plan_time(plan_items: dict) -> None:
-    global PLAN_ITEMS_BY_TIME
-    PLAN_ITEMS_BY_TIME = {}
+def _item_sequence_order(sequence: object) -> int:
+    """Sort position for an item; missing or non-numeric sequences go last."""
+    if isinstance(sequence, int):
+        return sequence
+    if isinstance(sequence, str):
+        try:
+            return int(sequence)
+        except ValueError:
+            pass
+    return sys.maxsize
+
 
+def map_items_by_plan_time(
+    plan_items: dict,
+    included: Dict[Tuple[str, str], dict],
+    plan_times: Dict[str, Union[datetime, str]],
+) -> Dict[str, List[Dict[str, object]]]:
     items = plan_items.get("data")
     if not isinstance(items, list):
-        return
+        return {}
 
+    # With no service times to filter on, every item time is kept.
+    allowed_times = frozenset(plan_times)
     aggregated: Dict[str, List[Dict[str, object]]] = defaultdict(list)
 
     for item in items:
-        if not isinstance(item, dict):
-            continue
-        relationships = item.get("relationships")
-        if not isinstance(relationships, dict):
-            continue
-        item_times_rel = relationships.get("item_times")
-        if not isinstance(item_times_rel, dict):
-            continue
-
-        refs = item_times_rel.get("data")
-        if not isinstance(refs, list) or not refs:
+        try:
+            refs = item["relationships"]["item_times"]["data"]
+            attributes = item.get("attributes")
+            if not isinstance(attributes, dict):
+                attributes = {}
+            item_id = item.get("id")
+            title = attributes.get("title")
+            sequence = attributes.get("sequence")
+            length = attributes.get("length")
+            order = _item_sequence_order(sequence)
+        except (TypeError, AttributeError, KeyError):
             continue
-        related_link = item_times_rel.get("links", {}).get("related")
-        if not isinstance(related_link, str):
+        if not isinstance(refs, list):
             continue
 
         for ref in refs:
-            if not isinstance(ref, dict):
+            try:
+                item_time_id = ref["id"]
+                item_time = included[("ItemTime", item_time_id)]
+                plan_time_id = item_time["relationships"]["plan_time"]["data"]["id"]
+            except (TypeError, KeyError):
                 continue
-            item_time_id = ref.get("id")
-            if not isinstance(item_time_id, str):
-                continue
-
-            detail = fetch_item_time_detail(related_link, item_time_id)
-            plan_time_rel = (
-                detail.get("data", {})
-                .get("relationships", {})
-                .get("plan_time", {})
-                .get("data", {})
-            )
-            plan_time_id = plan_time_rel.get("id") if isinstance(plan_time_rel, dict) else None
             if not isinstance(plan_time_id, str):
                 continue
 
-            if PLAN_TIMES and plan_time_id not in PLAN_TIMES:
+            if allowed_times and plan_time_id not in allowed_times:
                 continue
 
-            attributes = item.get("attributes") if isinstance(item.get("attributes"), dict) else {}
             aggregated[plan_time_id].append(
                 {
-                    "item_id": item.get("id"),
+                    "item_id": item_id,
                     "item_time_id": item_time_id,
-                    "title": attributes.get("title"),
-                    "sequence": attributes.get("sequence"),
-                    "length": attributes.get("length"),
+                    "title": title,
+                    "sequence": sequence,
+                    "length": length,
+                    "_order": order,
                 }
             )
 
-    PLAN_ITEMS_BY_TIME = dict(aggregated)
+    return dict(aggregated)
 
 
-def parse_iso_timestamp(value: str) -> Optional[datetime]:
-    try:
-        return datetime.fromisoformat(value)
-    except ValueError:
-        try:
-            return datetime.fromisoformat(value.replace("Z", "+00:00"))
-        except ValueError:
-            return None
-
+def format_time_label(dt: datetime) -> str:
+    """Format as e.g. "9:00 AM" without going through locale-aware strftime."""
+    hour = dt.hour % 12 or 12
+    meridiem = "AM" if dt.hour < 12 else "PM"
+    return f"{hour}:{dt.minute:02d} {meridiem}"
 
-def format_time_label(iso_timestamp: str) -> Tuple[Optional[datetime], str]:
-    dt = parse_iso_timestamp(iso_timestamp)
-    if dt is None:
-        return None, iso_timestamp
-    label = dt.strftime("%I:%M %p").lstrip("0")
-    return dt, label
 
-
-def _item_sequence_sort_key(item: Dict[str, object]) -> Tuple[int, int]:
-    sequence = item.get("sequence")
-    if isinstance(sequence, int):
-        return (0, sequence)
-    if isinstance(sequence, str):
-        try:
-            parsed = int(sequence)
-            return (0, parsed)
-        except ValueError:
-            pass
-    return (1, sys.maxsize)
-
-
-def build_plan_schedule() -> List[Tuple[str, List[Dict[str, object]]]]:
+def build_plan_schedule(
+    plan_times: Dict[str, Union[datetime, str]],
+    items_by_time: Dict[str, List[Dict[str, object]]],
+) -> List[Tuple[str, List[Dict[str, object]]]]:
     schedule: List[Tuple[Optional[datetime], str, List[Dict[str, object]]]] = []
 
-    for plan_time_id, iso_time in PLAN_TIMES.items():
-        items = PLAN_ITEMS_BY_TIME.get(plan_time_id)
+    for plan_time_id, starts_at in plan_times.items():
+        items = items_by_time.get(plan_time_id)
         if not items:
             continue
 
-        dt, label = format_time_label(iso_time)
-        sorted_items = sorted(
-            (item for item in items if isinstance(item, dict)),
-            key=_item_sequence_sort_key,
-        )
+        if isinstance(starts_at, datetime):
+            dt, label = starts_at, format_time_label(starts_at)
+        else:
+            dt, label = None, starts_at
+        sorted_items = sorted(items, key=itemgetter("_order"))
         simplified_items = []
         for index, item in enumerate(sorted_items, start=1):
             simplified_items.append(
@@ -317,37 +357,50 @@ def print_json(schedule: List[Tuple[str, List[Dict[str, object]]]]) -> None:
     print(json.dumps(output, indent=2))
 
 
-def print_text(schedule: List[Tuple[str, List[Dict[str, object]]]]) -> None:
-    lines: List[str] = []
+def iter_text_lines(
+    schedule: List[Tuple[str, List[Dict[str, object]]]]
+) -> Iterator[str]:
     for label, items in schedule:
-        lines.append(label)
+        yield label
         for item in items:
-            sequence = item.get("sequence")
-            length = item.get("length")
-            title = item.get("title")
+            get = item.get
+            sequence = get("sequence")
+            length = get("length")
             seq_display = sequence if sequence is not None else "-"
-            length_display = f"{length} seconds" if length is not None else "unknown length"
-            lines.append(f"{seq_display}: {title} - {length_display}")
-        lines.append("")
-    print("\n".join(lines).rstrip())
+            length_display = (
+                "%s seconds" % (length,) if length is not None else "unknown length"
+            )
+            yield "%s: %s - %s" % (seq_display, get("title"), length_display)
+        yield ""
+
+
+def print_text(schedule: List[Tuple[str, List[Dict[str, object]]]]) -> None:
+    sys.stdout.write("\n".join(iter_text_lines(schedule)).rstrip() + "\n")
 
 
 def main() -> None:
     args = parse_args()
 
+    # One opener for every call; it applies HTTP(S)_PROXY and follows redirects.
+    opener = request.build_opener()
     try:
-        fetch_plan(args.after_date)
-        if PLAN_ID is None:
+        app_id, secret = get_credentials()
+        headers = build_headers(app_id, secret)
+        plan_id = extract_plan_id(fetch_plan(args.after_date, opener, headers))
+        if plan_id is None:
             raise RuntimeError("No plan ID returned; unable to fetch plan times.")
-        plan_times = fetch_plan_times(PLAN_ID)
-        stash_service_times(plan_times)
-        plan_items = fetch_plan_items(PLAN_ID)
-        map_items_by_plan_time(plan_items)
+        plan_times = collect_service_times(
+            fetch_plan_times(plan_id, opener, headers)
+        )
+        plan_items, included = fetch_plan_items(plan_id, opener, headers)
+        items_by_time = map_items_by_plan_time(plan_items, included, plan_times)
     except RuntimeError as exc:
         print(exc, file=sys.stderr)
         sys.exit(1)
+    finally:
+        opener.close()
 
-    schedule = build_plan_schedule()
+    schedule = build_plan_schedule(plan_times, items_by_time)
     if args.format == "text":
         print_text(schedule)
     else: